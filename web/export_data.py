@@ -0,0 +1,453 @@
+"""Bulk export of CCBMk2 build statistics and model metadata.
+
+Streams the `build_log`, `build_requests` and `models` collections out
+of the database in batches, so memory use is bounded by the batch size
+rather than the size of the collections. Each dataset is written to
+gzip compressed NDJSON, Parquet or Arrow IPC files.
+
+A summary of build-time percentiles for each helix type and oligomeric
+state is also written alongside the exported data. The statistics are
+aggregated in the database and the percentiles are read from a sorted
+cursor, so only the requested ranks for each group are held in memory.
+
+Usage
+-----
+    python export_data.py OUTPUT_DIR [--format {ndjson,parquet,arrow}]
+                                     [--batch-size N]
+"""
+
+import argparse
+import datetime
+import gzip
+import itertools
+import json
+import math
+import os
+import sys
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from bson.objectid import ObjectId
+
+from ccbmk2 import database
+
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Column types for the columnar formats, 'json' columns hold nested
+# documents that are serialised to JSON strings.
+BUILD_LOG_COLUMNS = (
+    ('_id', 'string'),
+    ('ip', 'string'),
+    ('date', 'timestamp'),
+    ('build_time', 'float'),
+    ('build_request_id', 'string'),
+    ('helix_type', 'string'),
+    ('oligomeric_state', 'int')
+)
+BUILD_REQUESTS_COLUMNS = (
+    ('_id', 'string'),
+    ('helix_type', 'string'),
+    ('oligomeric_state', 'int'),
+    ('requested', 'int'),
+    ('parameter_ids', 'json')
+)
+MODELS_COLUMNS = (
+    ('_id', 'string'),
+    ('source', 'string'),
+    ('helix_type', 'string'),
+    ('oligomeric_state', 'int'),
+    ('score', 'float'),
+    ('mean_rpt_value', 'float'),
+    ('number_of_knobs', 'int'),
+    ('parameters', 'json')
+)
+
+
+def main():
+    """Parses the command line arguments and runs the export."""
+    parser = argparse.ArgumentParser(
+        description='Export CCBMk2 build statistics and model metadata.')
+    parser.add_argument('output_dir', help='Directory for exported files.')
+    parser.add_argument('--format', choices=sorted(WRITERS),
+                        default='ndjson', help='Output file format.')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Number of documents processed at a time.')
+    args = parser.parse_args()
+    summary = export_all(args.output_dir, args.format, args.batch_size)
+    print(format_summary(summary))
+    return
+
+
+def export_all(output_dir, file_format='ndjson', batch_size=1000):
+    """Exports all datasets and the build-time summary to `output_dir`.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory that the files are written to, created if required.
+    file_format : str
+        One of 'ndjson', 'parquet' or 'arrow'.
+    batch_size : int
+        Number of documents that are held in memory at any one time.
+
+    Returns
+    -------
+    summary : [dict]
+        Build-time percentiles for each helix type and oligomeric state.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    datasets = [
+        ('build_log', BUILD_LOG_COLUMNS, iter_build_log(batch_size)),
+        ('build_requests', BUILD_REQUESTS_COLUMNS,
+         iter_build_requests(batch_size)),
+        ('models', MODELS_COLUMNS, iter_models(batch_size)),
+    ]
+    for name, columns, batches in datasets:
+        writer_class = WRITERS[file_format]
+        path = os.path.join(
+            output_dir, '{}.{}'.format(name, writer_class.extension))
+        with writer_class(path, columns) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+        print('Exported {} to {}'.format(name, path), file=sys.stderr)
+    summary = summarise_build_times(batch_size)
+    summary_path = os.path.join(output_dir, 'build_time_summary.json')
+    with open(summary_path, 'w') as outf:
+        json.dump(summary, outf, indent=2)
+    return summary
+
+
+def iter_batches(cursor, batch_size):
+    """Yields lists of at most `batch_size` documents from a cursor."""
+    cursor = cursor.batch_size(batch_size)
+    while True:
+        batch = list(itertools.islice(cursor, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_build_log(batch_size):
+    """Yields batches of build log rows, labelled with their build request."""
+    for batch in iter_batches(database.build_log.find(), batch_size):
+        request_ids = {doc['build_request_id'] for doc in batch}
+        build_requests = {
+            br['_id']: br for br in database.build_requests.find(
+                {'_id': {'$in': list(request_ids)}},
+                {'helix_type': 1, 'parameter_ids': 1})
+        }
+        rows = []
+        for doc in batch:
+            build_request = build_requests.get(doc['build_request_id'], {})
+            helix_type = build_request.get('helix_type')
+            oligomeric_state = len(build_request.get('parameter_ids', [])) \
+                or None
+            rows.append({
+                '_id': doc['_id'],
+                'ip': doc.get('ip'),
+                'date': doc.get('date'),
+                'build_time': doc.get('build_time'),
+                'build_request_id': doc['build_request_id'],
+                'helix_type': helix_type,
+                'oligomeric_state': oligomeric_state
+            })
+        yield rows
+
+
+def iter_build_requests(batch_size):
+    """Yields batches of build request rows."""
+    for batch in iter_batches(database.build_requests.find(), batch_size):
+        yield [{
+            '_id': doc['_id'],
+            'helix_type': doc.get('helix_type'),
+            'oligomeric_state': len(doc.get('parameter_ids', [])) or None,
+            'requested': doc.get('requested'),
+            'parameter_ids': doc.get('parameter_ids', [])
+        } for doc in batch]
+
+
+def iter_models(batch_size):
+    """Yields batches of model metadata rows.
+
+    The PDB files are not exported. Models are stored under the id of
+    either the build request or the optimisation job that created
+    them, the parameters are resolved from `chain_parameters` for build
+    requests and taken from the final parameters of optimisation jobs.
+    """
+    cursor = database.models.find({}, {'pdb': 0})
+    for batch in iter_batches(cursor, batch_size):
+        model_ids = [doc['_id'] for doc in batch]
+        build_requests = {
+            br['_id']: br for br in database.build_requests.find(
+                {'_id': {'$in': model_ids}})
+        }
+        opt_jobs = {
+            oj['_id']: oj for oj in database.opt_jobs.find(
+                {'_id': {'$in': model_ids}},
+                {'helix_type': 1, 'oligomeric_state': 1,
+                 'final_parameters': 1})
+        }
+        parameter_ids = {
+            pid for br in build_requests.values()
+            for pid in br.get('parameter_ids', [])
+        }
+        chain_parameters = {
+            cp.pop('_id'): cp for cp in database.parameters_store.find(
+                {'_id': {'$in': list(parameter_ids)}})
+        }
+        rows = []
+        for doc in batch:
+            row = {
+                '_id': doc['_id'],
+                'source': None,
+                'helix_type': None,
+                'oligomeric_state': None,
+                'score': doc.get('score'),
+                'mean_rpt_value': doc.get('mean_rpt_value'),
+                'number_of_knobs': len(doc.get('knob_ids', [])),
+                'parameters': None
+            }
+            if doc['_id'] in build_requests:
+                build_request = build_requests[doc['_id']]
+                ids = build_request.get('parameter_ids', [])
+                row['source'] = 'build_request'
+                row['helix_type'] = build_request.get('helix_type')
+                row['oligomeric_state'] = len(ids) or None
+                row['parameters'] = [chain_parameters.get(pid) for pid in ids]
+            elif doc['_id'] in opt_jobs:
+                opt_job = opt_jobs[doc['_id']]
+                row['source'] = 'opt_job'
+                row['helix_type'] = opt_job.get('helix_type')
+                row['oligomeric_state'] = opt_job.get('oligomeric_state')
+                row['parameters'] = opt_job.get('final_parameters')
+            rows.append(row)
+        yield rows
+
+
+def percentile_ranks(count, pct):
+    """Ranks and weights for a linearly interpolated percentile.
+
+    Returns
+    -------
+    lower : int
+        Rank of the value below the percentile in the sorted values.
+    upper : int
+        Rank of the value above the percentile in the sorted values.
+    fraction : float
+        Weight given to the upper value.
+    """
+    position = (count - 1) * pct / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return lower, upper, position - lower
+
+
+def build_time_pipeline(cutoff):
+    """Aggregation stages labelling build times with their build request.
+
+    Only builds logged up to `cutoff` are included, so that repeated
+    aggregations see the same builds while the log is being written to.
+    """
+    return [
+        {'$match': {'build_time': {'$ne': None}, 'date': {'$lte': cutoff}}},
+        {'$lookup': {
+            'from': database.build_requests.name,
+            'localField': 'build_request_id',
+            'foreignField': '_id',
+            'as': 'build_request'
+        }},
+        {'$unwind': {
+            'path': '$build_request',
+            'preserveNullAndEmptyArrays': True
+        }},
+        {'$project': {
+            '_id': 0,
+            'build_time': 1,
+            'helix_type': {'$ifNull': ['$build_request.helix_type', None]},
+            'oligomeric_state': {'$size': {
+                '$ifNull': ['$build_request.parameter_ids', []]}}
+        }}
+    ]
+
+
+def summarise_build_times(batch_size):
+    """Calculates build-time statistics for each group of builds.
+
+    The count, mean and max are calculated by the database. The build
+    times are then streamed in order of helix type, oligomeric state
+    and build time, and only the values at the ranks needed for the
+    percentiles are kept.
+
+    Parameters
+    ----------
+    batch_size : int
+        Number of documents fetched from the sorted cursor at a time.
+
+    Returns
+    -------
+    summary : [dict]
+        Count, mean, max and percentiles of the build times for each
+        helix type and oligomeric state.
+    """
+    cutoff = datetime.datetime.now()
+    group_stats = database.build_log.aggregate(
+        build_time_pipeline(cutoff) + [{'$group': {
+            '_id': {'helix_type': '$helix_type',
+                    'oligomeric_state': '$oligomeric_state'},
+            'count': {'$sum': 1},
+            'mean': {'$avg': '$build_time'},
+            'max': {'$max': '$build_time'}
+        }}],
+        allowDiskUse=True)
+    groups = {}
+    wanted_ranks = {}
+    for stats in group_stats:
+        key = (stats['_id'].get('helix_type'),
+               stats['_id'].get('oligomeric_state'))
+        groups[key] = {
+            'helix_type': key[0],
+            'oligomeric_state': key[1] or None,
+            'count': stats['count'],
+            'mean': stats['mean'],
+            'max': stats['max']
+        }
+        wanted_ranks[key] = {}
+        for pct in PERCENTILES:
+            lower, upper, _ = percentile_ranks(stats['count'], pct)
+            wanted_ranks[key][lower] = None
+            wanted_ranks[key][upper] = None
+    sorted_times = database.build_log.aggregate(
+        build_time_pipeline(cutoff) + [{'$sort': {
+            'helix_type': 1, 'oligomeric_state': 1, 'build_time': 1}}],
+        allowDiskUse=True, batchSize=batch_size)
+    grouped_times = itertools.groupby(
+        sorted_times,
+        key=lambda x: (x.get('helix_type'), x.get('oligomeric_state')))
+    for key, docs in grouped_times:
+        ranks = wanted_ranks[key]
+        for rank, doc in enumerate(docs):
+            if rank in ranks:
+                ranks[rank] = doc['build_time']
+    summary = []
+    for key in sorted(groups, key=lambda x: (str(x[0]), x[1])):
+        group = groups[key]
+        ranks = wanted_ranks[key]
+        for pct in PERCENTILES:
+            lower, upper, fraction = percentile_ranks(group['count'], pct)
+            group['p{}'.format(pct)] = (ranks[lower] * (1 - fraction)
+                                        + ranks[upper] * fraction)
+        summary.append(group)
+    return summary
+
+
+def format_summary(summary):
+    """Formats the build-time summary as a plain text table."""
+    headers = (['helix_type', 'oligomeric_state', 'count', 'mean']
+               + ['p{}'.format(pct) for pct in PERCENTILES] + ['max'])
+    lines = ['\t'.join(headers)]
+    for group in summary:
+        fields = []
+        for header in headers:
+            value = group[header]
+            fields.append('{:.3f}'.format(value)
+                          if isinstance(value, float) else str(value))
+        lines.append('\t'.join(fields))
+    return '\n'.join(lines)
+
+
+def to_json_value(value):
+    """Converts values from the database into JSON serialisable types."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat()
+    elif isinstance(value, dict):
+        return {k: to_json_value(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [to_json_value(v) for v in value]
+    return value
+
+
+class NDJSONWriter:
+    """Writes rows to a gzip compressed newline delimited JSON file."""
+    extension = 'ndjson.gz'
+
+    def __init__(self, path, columns):
+        self.columns = [name for name, _ in columns]
+        self.outf = gzip.open(path, 'wt')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.outf.close()
+
+    def write_batch(self, rows):
+        for row in rows:
+            record = {name: to_json_value(row[name])
+                      for name in self.columns}
+            self.outf.write(json.dumps(record) + '\n')
+
+
+class ArrowWriter:
+    """Writes rows to an Arrow IPC file one record batch at a time."""
+    extension = 'arrow'
+
+    def __init__(self, path, columns):
+        types = {
+            'string': pyarrow.string(),
+            'float': pyarrow.float64(),
+            'int': pyarrow.int64(),
+            'timestamp': pyarrow.timestamp('us'),
+            'json': pyarrow.string()
+        }
+        self.columns = columns
+        self.schema = pyarrow.schema(
+            [(name, types[col_type]) for name, col_type in columns])
+        self.writer = self._open(path)
+
+    def _open(self, path):
+        return pyarrow.ipc.new_file(path, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.writer.close()
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        data = {name: [] for name, _ in self.columns}
+        for row in rows:
+            for name, col_type in self.columns:
+                value = row[name]
+                if col_type == 'json':
+                    value = json.dumps(to_json_value(value))
+                elif isinstance(value, ObjectId):
+                    value = str(value)
+                data[name].append(value)
+        table = pyarrow.Table.from_pydict(data, schema=self.schema)
+        self.writer.write_table(table)
+
+
+class ParquetWriter(ArrowWriter):
+    """Writes rows to a Parquet file, one row group per batch."""
+    extension = 'parquet'
+
+    def _open(self, path):
+        return pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression='snappy')
+
+
+WRITERS = {
+    'ndjson': NDJSONWriter,
+    'arrow': ArrowWriter,
+    'parquet': ParquetWriter
+}
+
+
+if __name__ == '__main__':
+    main()